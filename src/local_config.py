@@ -1,3 +1,5 @@
+import os
+
 from Rignak.init import ExistingFilename
 
 INPUT_FOLDER = '.tmp/input'
@@ -5,3 +7,7 @@ OUTPUT_FOLDER = '.tmp/output'
 BACKUP_FOLDER = 'backup'
 
 INSTRUCTION_FILENAME = ExistingFilename('todo.txt')
+
+# SVT-AV1 ignores ffmpeg's `-threads`; it must be bounded through
+# `-svtav1-params lp=N` (valid range 0-6). Keep lp * pool size ~= cpu_count.
+SVTAV1_LP = max(1, min(6, os.cpu_count() // max(1, os.cpu_count() // 3)))
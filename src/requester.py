@@ -1,18 +1,72 @@
-import glob
+import itertools
+import json
 import os
+import re
 
 os.environ['DISABLE_RIGNAK_BACKUP'] = "True"
 
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from functools import lru_cache
 
-import fire
-import pytubefix as pytube
 import typing
 
 import ffmpeg_requester.local_config as config
 from rignak.src.init import ExistingFilename, assert_argument_types, logger
-from rignak.src.textfile_utils import get_lines
+
+_probe_cache: dict = {}
+_mkdir_cache: set = set()
+
+_TABS_RE = re.compile(r'\t+')
+
+
+def ensure_dir(folder: str) -> None:
+    # os.makedirs stats the whole path even with exist_ok; batches share a
+    # handful of directories, so remember the ones already created.
+    if folder not in _mkdir_cache:
+        os.makedirs(folder, exist_ok=True)
+        _mkdir_cache.add(folder)
+
+
+@lru_cache(maxsize=None)
+def get_av1_encoder() -> str:
+    # Probed lazily (and once per run) so dry runs never spawn ffmpeg.
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True)
+    except OSError:
+        return 'libsvtav1'
+    for encoder in ('av1_nvenc', 'av1_qsv', 'av1_amf'):
+        if encoder in result.stdout:
+            return encoder
+    return 'libsvtav1'
+
+
+@lru_cache(maxsize=4096)
+def get_existing_filename(path: str, message: str) -> ExistingFilename:
+    # Multi-clip extracts reuse the same source; cache so it is only stat'd once.
+    return ExistingFilename(path, message=message)
+
+
+_OUTPUT_TRANS = str.maketrans({'?': '', "'": '', '"': "'"})
+
+
+def probe_resolution(input_filename: str) -> (None, tuple):
+    if input_filename not in _probe_cache:
+        argv = [
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'stream=width,height',
+            '-print_format', 'json',
+            input_filename,
+        ]
+        try:
+            result = subprocess.run(argv, capture_output=True, text=True)
+            stream = json.loads(result.stdout)['streams'][0]
+            _probe_cache[input_filename] = (stream['width'], stream['height'])
+        except (OSError, json.JSONDecodeError, KeyError, IndexError):
+            _probe_cache[input_filename] = None
+    return _probe_cache[input_filename]
 
 
 class Requester():
@@ -27,29 +81,45 @@ class Requester():
         self.input_filename: (None, ExistingFilename) = None
         self.line: (None, str) = None
         self.output_filename: (None, str) = output_filename
-        self.duration: str = ""
-        self.start: str = ""
+        self.duration: list = []
+        self.start: list = []
         self.command: (None, str) = None
+        self.argv: (None, list) = None
         self.ready: bool = False
 
+        encoder = get_av1_encoder()
         self.video_options: list = [
-            '-c:v libsvtav1',
-            '-c:s copy',
-            '-c:a copy',
-            "-map 0:a",
-            "-map 0:v:0",
-            "-map 0:s?",
-            "-force_key_frames 0",
-            "-crf 32",
-            "-threads 3",
-            "-pix_fmt yuv420p10le",
+            '-c:v', encoder,
+            '-c:s', 'copy',
+            '-c:a', 'copy',
+            '-map', '0:a',
+            '-map', '0:v:0',
+            '-map', '0:s?',
+            '-force_key_frames', '0',
         ]
+        if encoder == 'libsvtav1':
+            self.video_options.extend([
+                '-crf', '32',
+                '-svtav1-params', f'lp={config.SVTAV1_LP}:pin=1',
+                '-preset', '8',
+                '-pix_fmt', 'yuv420p10le',
+            ])
+        else:
+            # Each hardware encoder has its own quality flag (-cq is
+            # NVENC-private and silently dropped elsewhere), and they take
+            # p010le instead of yuv420p10le for 10-bit input.
+            quality_options = {
+                'av1_nvenc': ['-cq', '32'],
+                'av1_qsv': ['-global_quality', '32'],
+                'av1_amf': ['-rc', 'cqp', '-qp_i', '32', '-qp_p', '32'],
+            }[encoder]
+            self.video_options.extend([*quality_options, '-pix_fmt', 'p010le'])
         self.audio_options: list = [
-            '-codec:a libmp3lame',
-            '-qscale:a 3'
+            '-codec:a', 'libmp3lame',
+            '-qscale:a', '3'
         ]
         self.options: list = [
-            "-v quiet"
+            '-v', 'quiet'
         ]
         try:
             self.set_input_file(input_filename)
@@ -62,12 +132,20 @@ class Requester():
         if output_filename.startswith('-'):
             self.ready = False
 
+        if self.ready:
+            # The options are only mutated during construction, so the argv can
+            # be frozen here instead of being rebuilt on every run() call.
+            self.argv = self.build_argv()
+            self.command = subprocess.list2cmdline(self.argv)
+
     @assert_argument_types
     def get_input_from_youtube(
             self: 'Requester',
             url: str,
             output_path: str = config.INPUT_FOLDER
     ) -> ExistingFilename:
+        import pytubefix as pytube
+
         logger(f'Download from {url}')
         yt = pytube.YouTube(url)
         input_filename = yt.streams.get_highest_resolution().download(output_path=output_path)
@@ -83,6 +161,8 @@ class Requester():
     ) -> None:
         ok = False
         if 'youtube.com' in input_filename:
+            import pytubefix as pytube
+
             try:
                 input_filename = self.get_input_from_youtube(input_filename)
                 ok = True
@@ -91,7 +171,7 @@ class Requester():
         if not ok:
             input_filename = os.path.join(input_folder, input_filename)
             message = f"{os.path.basename(input_filename)}: Source not found."
-            input_filename = ExistingFilename(input_filename, message=message)
+            input_filename = get_existing_filename(input_filename, message)
 
         self.input_filename = input_filename
 
@@ -108,7 +188,7 @@ class Requester():
             self.options += self.audio_options
 
             title = os.path.basename(os.path.splitext(self.output_filename)[0])
-            self.options.append(f'-metadata title="{title}"')
+            self.options.extend(['-metadata', f'title={title}'])
 
         elif self.output_filename.endswith('.mkv'):
             self.add_resize_option()
@@ -123,17 +203,14 @@ class Requester():
         if end_timestring == '00:00:00':
             return
 
-        timestrings = {}
-        for key, timestring in (('start', start_timestring), ('end', end_timestring)):
-            hour = int(timestring[:2])
-            minute = int(timestring[3:5])
-            second = int(timestring[6:8])
-            timestrings[key] = hour * 3600 + minute * 60 + second
+        # strptime also validates the format, which the manual slicing did not.
+        start = datetime.strptime(start_timestring, '%H:%M:%S')
+        end = datetime.strptime(end_timestring, '%H:%M:%S')
+        duration = end - start
 
-        duration = timestrings['end'] - timestrings['start']
         message = f"{os.path.basename(self.output_filename)}: Check duration."
-        assert duration > 0, message
-        self.duration = f"-t {duration // 3600:02d}:{duration % 3600 // 60:02d}:{duration % 60:02d}"
+        assert duration.total_seconds() > 0, message
+        self.duration = ['-t', str(duration)]
 
     @assert_argument_types
     def set_start(
@@ -143,33 +220,88 @@ class Requester():
         if start_timestring == '00:00:00':
             return
 
-        self.start = f"-ss {start_timestring}"
+        self.start = ['-ss', start_timestring]
 
     @assert_argument_types
     def add_resize_option(self: 'Requester'):
-        command = 'ffprobe -v error -select_streams v:0 -show_entries stream=width,height ' \
-                  f'-of csv=s=x:p=0 "{self.input_filename}"'
-        if '1080' in subprocess.run(command, stdout=subprocess.PIPE).stdout.decode('utf-8'):
-            self.video_options.append("-vf \"scale=trunc(iw/2)*2:720\"")
+        resolution = probe_resolution(str(self.input_filename))
+        if resolution is None:
+            self.video_options.extend(['-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2'])
+            return
+
+        width, height = resolution
+        if height <= 720 and width % 2 == 0 and height % 2 == 0:
+            # Already small enough with even dimensions: omitting `-vf` lets
+            # the encoder read the planes directly, skipping a scaling pass.
+            return
+
+        if height >= 1080:
+            self.video_options.extend(['-vf', 'scale=trunc(iw/2)*2:720'])
         else:
-            self.video_options.append("-vf \"scale=trunc(iw/2)*2:trunc(ih/2)*2\"")
+            self.video_options.extend(['-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2'])
             
 
     @assert_argument_types
-    def run(self: 'Requester', only_generate_command: bool = False) -> str:
-        self.command = f'ffmpeg {self.start} -i "{self.input_filename}" ' \
-                       f'{self.duration} {" ".join(self.options)} "{self.output_filename}"'
+    def build_argv(self: 'Requester') -> list:
+        # `-noaccurate_seek` is an input option: it keeps the input-side `-ss`
+        # jumping to the nearest keyframe instead of decoding up to the offset
+        # (`-force_key_frames 0` covers the gap on the re-encode side).
+        argv = ['ffmpeg']
+        if self.start and self.output_filename.endswith('.mkv'):
+            argv.append('-noaccurate_seek')
+        argv += [
+            *self.start,
+            '-i', str(self.input_filename),
+            *self.duration,
+            *self.options,
+            self.output_filename,
+        ]
+        return argv
 
+    @assert_argument_types
+    def run(self: 'Requester', only_generate_command: bool = False) -> str:
         if not only_generate_command:
             print(self.command)
-            os.system(self.command)
-
-            if not os.path.exists(self.output_filename):
-                logger.error(f'No file created: {self.output_filename}')
-            elif os.path.getsize(self.output_filename) < 1024:
-                logger.error(f'Very small file created: {self.output_filename}')
+            result = subprocess.run(self.argv, check=False, capture_output=True)
+            self.check_output(result)
         return self.command
 
+    @assert_argument_types
+    def check_output(self: 'Requester', result: subprocess.CompletedProcess) -> None:
+        # `-v quiet` plus the captured output would otherwise leave failures
+        # completely silent; surface ffmpeg's verdict with the warning.
+        details = f"ffmpeg returned {result.returncode}: " \
+                  f"{result.stderr.decode('utf-8', errors='replace').strip()}"
+        if not os.path.exists(self.output_filename):
+            logger.error(f'No file created: {self.output_filename} ({details})')
+        elif os.path.getsize(self.output_filename) < 1024:
+            logger.error(f'Very small file created: {self.output_filename} ({details})')
+
+
+@assert_argument_types
+def run_group(requesters: list, only_generate_command: bool = False) -> str:
+    if len(requesters) == 1:
+        return requesters[0].run(only_generate_command=only_generate_command)
+
+    # One `-i` shares the demuxer between all clips of the source; seek and
+    # duration become per-output options.
+    argv = ['ffmpeg', '-i', str(requesters[0].input_filename)]
+    for requester in requesters:
+        argv += [
+            *requester.start,
+            *requester.duration,
+            *requester.options,
+            requester.output_filename,
+        ]
+    command = subprocess.list2cmdline(argv)
+
+    if not only_generate_command:
+        print(command)
+        result = subprocess.run(argv, check=False, capture_output=True)
+        for requester in requesters:
+            requester.check_output(result)
+    return command
+
 
 @assert_argument_types
 def backup(commands: list, backup_folder: str = config.BACKUP_FOLDER):
@@ -182,13 +314,26 @@ def backup(commands: list, backup_folder: str = config.BACKUP_FOLDER):
         file.writelines(commands)
 
 
+def _walk_mkv(root):
+    try:
+        entries = os.scandir(root)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_mkv(entry.path)
+            elif entry.name.endswith('.mkv'):
+                yield entry.path
+
+
 def get_exists():  # /!\ This use the basename, so all basename should be different.
     roots = (config.OUTPUT_FOLDER, "D:\\OneDrive/Videos")
-    available_filenames = [
+    available_filenames = {
         os.path.basename(filename)
         for root in roots
-        for filename in glob.glob(root + "/**/*.mkv", recursive=True)
-    ]
+        for filename in _walk_mkv(root)
+    }
     logger(f"Found {len(available_filenames)} existing .mkv.")
 
     def exists(filename):
@@ -197,7 +342,28 @@ def get_exists():  # /!\ This use the basename, so all basename should be differ
 
     return exists
 
-def get_requesters(lines:typing.Sequence[str], return_args:bool=False) -> typing.Union[typing.List[typing.Sequence[str]], typing.List[Requester]]:
+@lru_cache(maxsize=None)
+def parse_line(line: str) -> (None, tuple):
+    line = _TABS_RE.sub('\t', line)
+    split_line = line.split('\t')
+    if len(split_line) != 4:
+        if len(split_line) > 3:
+            logger.warning(f'Check delimiters: {split_line}')
+        return None
+
+    output_filename, start_timestring, end_timestring, input_filename = split_line
+    output_filename = output_filename.translate(_OUTPUT_TRANS)
+    return input_filename, output_filename, start_timestring, end_timestring
+
+
+def iter_lines(filename: str) -> typing.Iterator[str]:
+    # Streams the instruction file so it is never fully held in memory.
+    with open(filename, encoding='utf-8') as file:
+        for line in file:
+            yield line.rstrip('\n')
+
+
+def get_requesters(lines:typing.Iterable[str], return_args:bool=False) -> typing.Union[typing.List[typing.Sequence[str]], typing.List[Requester]]:
     args = []
     exists = get_exists()
     requesters = []
@@ -215,29 +381,26 @@ def get_requesters(lines:typing.Sequence[str], return_args:bool=False) -> typing
             break
         
             
-        while '\t\t' in line:
-            line = line.replace('\t\t', '\t')
-        split_line = line.split('\t')
-        if len(split_line) != 4:
-            if len(split_line) >3:
-                logger.warning(f'Check delimiters: {split_line}')
-        else:
-            output_filename, start_timestring, end_timestring, input_filename = split_line
-            output_filename = output_filename.replace("?", "").replace("'", "").replace('"', "'")
+        parsed = parse_line(line)
+        if parsed is not None:
+            input_filename, output_filename, start_timestring, end_timestring = parsed
 
-            args.append((input_filename, output_filename, start_timestring, end_timestring))
+            args.append(parsed)
             if exists(output_filename) or return_args:
                 continue
 
-            requester = Requester(*args[-1])  
-            if not requester.ready:
-                continue
-            elif os.path.exists(requester.output_filename):
-                logger(f'Already processed: {requester.output_filename}')
-                if os.path.getsize(requester.output_filename) < 1024:
-                    logger.warning(f'Please check: {requester.output_filename}')
+            # Check the output before building the Requester: construction may
+            # probe the source with ffprobe or even fetch it from YouTube.
+            output_path = os.path.join(config.OUTPUT_FOLDER, output_filename)
+            if os.path.exists(output_path):
+                logger(f'Already processed: {output_path}')
+                if os.path.getsize(output_path) < 1024:
+                    logger.warning(f'Please check: {output_path}')
                     commands.append(original_line + '\n')
-            elif requester.ready:
+                continue
+
+            requester = Requester(*args[-1])
+            if requester.ready:
                 requesters.append(requester)
     return args if return_args else requesters
     
@@ -245,33 +408,53 @@ def get_requesters(lines:typing.Sequence[str], return_args:bool=False) -> typing
 
 def main(instruction_filename: ExistingFilename = config.INSTRUCTION_FILENAME, prerun: bool = False) -> None:
 
-    lines = get_lines(instruction_filename)
-    requesters = get_requesters(lines)
+    lines = iter_lines(instruction_filename)
 
     if prerun:
-        used_filenames = [
-            os.path.basename(requester.input_filename)
-            for requester in requesters
-        ]
+        # The args are plain tuples: no Requester is built, so the prerun
+        # listing triggers no ffprobe spawn and no YouTube fetch.
+        args = get_requesters(lines, return_args=True)
+        used_filenames = {
+            os.path.basename(input_filename)
+            for input_filename, *_ in args
+        }
         unused_filename = [filename for filename in os.listdir(config.INPUT_FOLDER) if filename not in used_filenames]
         logger("Won't use some files. Can use these commands:")
         for filename in unused_filename:
             print(f'del "{filename}"')
-        
+
         return
 
-    logger.set_iterator(len(requesters))
-    commands = []
-    for requester in requesters:
-        os.makedirs(os.path.dirname(requester.output_filename), exist_ok=True)
+    requesters = get_requesters(lines)
 
-        command = requester.run()
-        logger.iterate(message=command)
-        commands.append(command + '\n')
+    # Clips cut from the same source share one ffmpeg call (one decode pass
+    # serves all of them).
+    requesters.sort(key=lambda requester: str(requester.input_filename))
+    groups = [
+        list(group)
+        for _, group in itertools.groupby(requesters, key=lambda requester: str(requester.input_filename))
+    ]
+
+    logger.set_iterator(len(groups))
+    commands = []
+    max_workers = max(1, os.cpu_count() // 3)  # each job is capped at config.SVTAV1_LP threads
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for group in groups:
+            for requester in group:
+                ensure_dir(os.path.dirname(requester.output_filename))
+            futures.append(executor.submit(run_group, group))
+
+        for future in as_completed(futures):
+            command = future.result()
+            logger.iterate(message=command)
+            commands.append(command + '\n')
 
     backup(commands)
     os.system("../output/remove_black.bat")
 
 
 if __name__ == '__main__':
+    import fire
+
     fire.Fire(main)
@@ -1,74 +1,114 @@
 import argparse
 import os
+import subprocess
 import sys
-from pydub import AudioSegment, exceptions as pydub_exceptions
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from rignak.logging_utils import logger
 import glob
-import mutagen
 
-# Easily configurable list of supported input audio extensions
-SUPPORTED_EXTENSIONS = ['.wav', '.flac', '.ogg', '.aiff', '.mp3']  # MP3 added for re-encoding or tag updates
+# Easily configurable set of supported input audio extensions
+SUPPORTED_EXTENSIONS = frozenset({'.wav', '.flac', '.ogg', '.aiff', '.mp3'})  # MP3 added for re-encoding or tag updates
 
 
-def convert_audio_file(input_path: str, output_path: str, bitrate_val: str, compression_val: int) -> bool:
+_mkdir_cache = set()
+
+
+def ensure_dir(folder: str) -> None:
     """
-    Converts a single audio file to MP3 using the specified parameters,
-    preserving relevant metadata using mutagen.
+    Creates the directory once per process; os.makedirs stats the whole
+    path on every call even with exist_ok=True.
     """
-    audio_format = os.path.splitext(input_path)[1][1:].lower()
+    if folder not in _mkdir_cache:
+        os.makedirs(folder, exist_ok=True)
+        _mkdir_cache.add(folder)
+
 
+def walk_files(root: str):
+    """
+    Recursive os.scandir walk; DirEntry caches the file type, avoiding the
+    extra stat calls os.walk pays per entry. Unreadable directories are
+    skipped, as os.walk did.
+    """
     try:
-        audio_tags_to_export = {}
-        try:
-            mutagen_file = mutagen.File(input_path)
-            if mutagen_file and mutagen_file.tags:
-                common_keys = {
-                    'artist', 'album', 'title', 'genre', 'date', 'year', 'tracknumber',
-                    'tracktotal', 'discnumber', 'disctotal', 'comment', 'composer',
-                    'albumartist', 'language'
-                }
-
-                for key in common_keys:
-                    if key in mutagen_file.tags:
-                        value = mutagen_file.tags[key]
-                        if isinstance(value, list) and len(value) > 0:
-                            audio_tags_to_export[key] = str(value[0])
-                        else:
-                            audio_tags_to_export[key] = str(value)
-
-                for key, value in mutagen_file.tags.items():
-                    if key not in audio_tags_to_export and isinstance(value, str):
-                        audio_tags_to_export[key.lower()] = value  # Ensure keys are lowercase for consistency
-                    elif key not in audio_tags_to_export and isinstance(value, list) and len(value) > 0 and isinstance(
-                            value[0], str):
-                        audio_tags_to_export[key.lower()] = value[0]
-
-
-        except Exception as e:
-            logger(f"WARNING: Could not read tags from '{input_path}' using mutagen: {e}. "
-                   "Proceeding with conversion without transferring existing tags.")
-            audio_tags_to_export = {}
-        audio = AudioSegment.from_file(input_path, format=audio_format)
-
-        output_dir = os.path.dirname(output_path)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir, exist_ok=True)
-
-        export_params = {
-            'format': "mp3",
-            'bitrate': bitrate_val,
-            'parameters': ['-q:a', str(compression_val)],
-            'tags': audio_tags_to_export
+        entries = os.scandir(root)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_files(entry.path)
+            elif entry.is_file():
+                yield entry
+
+
+def copy_tags(input_path: str, output_path: str) -> None:
+    """
+    Fallback tag transfer for the rare formats where ffmpeg's
+    `-map_metadata 0` drops tags.
+    """
+    import mutagen
+
+    try:
+        # easy=True normalizes the tags into a dict-like view, so a single
+        # comprehension replaces the per-format key juggling.
+        mutagen_file = mutagen.File(input_path, easy=True)
+        tags = mutagen_file.tags if mutagen_file else None
+        audio_tags_to_export = {
+            key.lower(): (str(value[0]) if isinstance(value, list) and value else str(value))
+            for key, value in (tags or {}).items()
         }
-        audio.export(output_path, **export_params)
+
+        if not audio_tags_to_export:
+            return
+
+        output_file = mutagen.File(output_path, easy=True)
+        if output_file is None:
+            return
+        for key, value in audio_tags_to_export.items():
+            try:
+                output_file[key] = value
+            except (KeyError, ValueError):
+                continue
+        output_file.save()
+    except Exception as e:
+        logger(f"WARNING: Could not transfer tags from '{input_path}' using mutagen: {e}.")
+
+
+def convert_audio_file(input_path: str, output_path: str, bitrate_val: str, compression_val: int) -> bool:
+    """
+    Converts a single audio file to MP3 with a direct ffmpeg call.
+
+    ffmpeg decodes and encodes in one process and copies the tags
+    natively through `-map_metadata 0`, so the input is never loaded
+    into Python memory.
+    """
+    import mutagen
+
+    try:
+        ensure_dir(os.path.dirname(output_path))
+
+        command = [
+            'ffmpeg', '-y', '-v', 'error',
+            '-i', input_path,
+            '-map_metadata', '0',
+            '-codec:a', 'libmp3lame',
+            '-b:a', bitrate_val,
+            '-q:a', str(compression_val),
+            output_path,
+        ]
+        subprocess.run(command, check=True, capture_output=True)
+
+        output_file = mutagen.File(output_path)
+        if output_file is None or not output_file.tags:
+            copy_tags(input_path, output_path)
         return True
 
     except FileNotFoundError:
         logger.error(f"File not found '{input_path}'.")
-    except pydub_exceptions.CouldntDecodeError:
+    except subprocess.CalledProcessError as e:
         logger.error(
-            f"Could not decode audio file '{input_path}'. "
-            f"It might be corrupted or an unsupported format variant."
+            f"Could not convert '{input_path}': "
+            f"{e.stderr.decode('utf-8', errors='replace').strip()}"
         )
     except Exception as e:
         logger.error(f"Could not convert '{input_path}': {e}")
@@ -124,25 +164,32 @@ def main(source: str, target: str, bitrate: str, compression: int) -> None:
         logger.error(f"Could not create target directory '{target}': {e}")
         sys.exit(1)
 
-    logger(f"Processing directory recursively: {source}")
     args = []
-    for folder, _, basenames in os.walk(source):
-        input_filenames = [
-            os.path.join(folder, basename)
-            for basename in basenames
-            if os.path.splitext(basename)[1].lower() in SUPPORTED_EXTENSIONS
-        ]
-
-        for input_filename in sorted(input_filenames):
-            output_filename = os.path.join(target, os.path.relpath(input_filename, source))
-            output_filename = os.path.splitext(output_filename)[0] + ".mp3"
-            args.append((input_filename, output_filename, bitrate, compression))
+    if os.path.isfile(source):
+        # --source may point at a single audio file instead of a directory.
+        logger(f"Processing single file: {source}")
+        base_folder = os.path.dirname(source)
+        input_filenames = [source] if source[source.rfind('.'):].lower() in SUPPORTED_EXTENSIONS else []
+    else:
+        logger(f"Processing directory recursively: {source}")
+        base_folder = source
+        input_filenames = sorted(
+            entry.path
+            for entry in walk_files(source)
+            if entry.name[entry.name.rfind('.'):].lower() in SUPPORTED_EXTENSIONS
+        )
+    for input_filename in input_filenames:
+        output_filename = os.path.join(target, os.path.relpath(input_filename, base_folder))
+        output_filename = os.path.splitext(output_filename)[0] + ".mp3"
+        args.append((input_filename, output_filename, bitrate, compression))
 
     logger(f"Found {len(args)} files to convert.")
     logger.set_iterator(len(args))
-    for arg in args:
-        logger.iterate(f"Process {arg[0]}")
-        convert_audio_file(*arg)
+    # libmp3lame is single-threaded, so one worker per core scales near-linearly.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {executor.submit(convert_audio_file, *arg): arg for arg in args}
+        for future in as_completed(futures):
+            logger.iterate(f"Processed {futures[future][0]}")
 
 
 if __name__ == "__main__":